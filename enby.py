@@ -1,18 +1,73 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
+import argparse
+import atexit
+import gzip
+import hashlib
+import html
 import json
 import os
-import sys
-from typing import Dict, List
+import re
+import shelve
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain, islice
+from string import Template
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+from urllib.parse import quote
 
 import numpy as np
 import pandas as pd
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+try:
+    import requests_cache
+except ImportError:  # without requests-cache every run queries the services again
+    requests_cache = None
+try:
+    import ijson
+except ImportError:  # without ijson responses are parsed in one go
+    ijson = None
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Errors raised for responses that aren't valid JSON
+if ijson is not None:
+    JSON_ERRORS = (json.JSONDecodeError, ijson.JSONError)
+else:
+    JSON_ERRORS = (json.JSONDecodeError,)
 
 # Constants
 PETS_CAN_URL = "https://petscan.wmflabs.org/"
 WIKIDATA_SPARQL_ENDPOINT = "https://query.wikidata.org/sparql"
 WIKIPEDIA_API_URL_TEMPLATE = "https://{lang}.wikipedia.org/w/api.php"
+# Wikimedia asks clients to identify themselves with a way to contact them
+USER_AGENT = "enby_wiki_comparison/1.0 (https://github.com/Nudin/enby_wiki_comparison)"
+NONBINARY_QID = "Q48270"
+# The qid at the end of an entity URI, whether http or https
+QID_PATTERN = r"/(Q\d+)$"
+# Characters to escape in SPARQL string literals
+SPARQL_STRING_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"'})
+# Longer SPARQL queries are sent as POST, to not exceed the URL length limit
+SPARQL_MAX_GET_LENGTH = 2000
+# WDQS allows only a few parallel queries per client
+SPARQL_MAX_WORKERS = 4
+MISSING_TITLES_BATCH_SIZE = 200
+# The main query is split by the first digit of the qid, so that each part
+# stays well below the query timeout. Qids never start with 0.
+SPARQL_QID_PREFIXES = "123456789"
+# The MediaWiki API accepts at most 50 titles per request (for non-bots)
+MEDIAWIKI_MAX_TITLES = 50
+MEDIAWIKI_MAX_WORKERS = 4
+# Back off when the database replication lag is higher than this (in seconds)
+MEDIAWIKI_MAXLAG = 5
 
 LANG_CODES = {
     "en": "English",
@@ -27,6 +82,92 @@ CATEGORIES = {
     "es": "Personas no binarias",
 }
 
+# Text and class of a table cell, indexed by has_site << 1 | has_gender.
+# Non-binary cells show the gender itself instead of a fixed text.
+CELL_TEXTS = np.array(["no article", "no article", "binary gender?", ""], dtype=object)
+CELL_CLASSES = np.array(["missing", "missing", "wrong", "nonbinary"], dtype=object)
+WRONG, NONBINARY = 2, 3
+
+HTTP_CACHE_FILE = "enby_cache"
+# Less than a day, so that daily runs always get fresh data
+HTTP_CACHE_EXPIRY = 12 * 3600  # seconds
+# Labels of gender items, they rarely change so they are kept between runs
+GENDER_LABELS_FILE = "gender_labels.json"
+# The last collated table, reused while the downloaded data stays the same
+COLLATE_CACHE_FILE = "enby_collate_cache"
+# Increase when collate changes its output, to not reuse tables made by older code
+COLLATE_CACHE_VERSION = 1
+# The HTML page, next to sort.js that it includes
+TEMPLATE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "template.html"
+)
+
+# The comment that refresh adds to SPARQL queries, as it appears url-encoded
+SPARQL_REFRESH_COMMENT = re.compile(r"%0A%23\d+(?=&|$)")
+
+
+def cache_key(request: requests.PreparedRequest, **kwargs) -> str:
+    """Create the cache key of a request, without the comment added by refresh."""
+    # Refreshed results are stored for the next runs, which don't add the comment
+    request = request.copy()
+    request.url = SPARQL_REFRESH_COMMENT.sub("", request.url)
+    if isinstance(request.body, str):
+        request.body = SPARQL_REFRESH_COMMENT.sub("", request.body)
+    return requests_cache.create_key(request, **kwargs)
+
+
+# Shared session, so that connections to the same host are kept alive and reused
+if requests_cache is not None:
+    # Reruns are answered from the on-disk cache, unless the server says otherwise
+    SESSION = requests_cache.CachedSession(
+        HTTP_CACHE_FILE,
+        backend="sqlite",
+        expire_after=HTTP_CACHE_EXPIRY,
+        allowable_methods=("GET", "HEAD", "POST"),
+        cache_control=True,
+        stale_if_error=True,
+        # Don't keep MediaWiki API errors like maxlag, they have to be retried
+        filter_fn=lambda response: "MediaWiki-API-Error" not in response.headers,
+        key_fn=cache_key,
+    )
+else:
+    SESSION = requests.Session()
+# A CachedSession reads every body completely to store it, even with stream=True,
+# so results can only be parsed while they arrive from a plain session
+STREAM_JSON = ijson is not None and requests_cache is None
+
+# Retry when the services are overloaded or throttle us, with exponential backoff
+RETRY = Retry(
+    total=5,
+    backoff_factor=1.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET", "HEAD", "POST"],
+)
+SESSION.mount(
+    "https://", HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=RETRY)
+)
+SESSION.headers["User-Agent"] = USER_AGENT
+# Close the pooled connections and the cache database on exit
+atexit.register(SESSION.close)
+
+
+def chunked(iterable: Iterable[str], size: int) -> Iterator[List[str]]:
+    """Split an iterable into lists of at most size items."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def decode_json(response: requests.Response) -> Any:
+    """Decode a buffered JSON response, dropping it from the cache if it's broken."""
+    try:
+        return json_loads(response.content)
+    except JSON_ERRORS:
+        # A truncated body, e.g. from a timeout, would be replayed by later runs
+        if requests_cache is not None:
+            SESSION.cache.delete(requests=[response.request])
+        raise
+
 
 def get_articles_from_category(
     category: str, lang: str = "en", depth: int = 10
@@ -47,16 +188,22 @@ def get_articles_from_category(
 
     try:
         # Make the request to the Petscan API
-        response = requests.get(PETS_CAN_URL, params=params, timeout=180)
-        response.raise_for_status()
-
-        # Parse the JSON response
-        data = response.json()
+        with SESSION.get(
+            PETS_CAN_URL, params=params, timeout=180, stream=True
+        ) as response:
+            response.raise_for_status()
+
+            # Navigate to results in the nested structure
+            if STREAM_JSON:
+                # Parse the pages while they arrive, without building the whole document
+                response.raw.decode_content = True
+                pages = ijson.items(response.raw, "*.item.a.*.item")
+            else:
+                data = decode_json(response)
+                pages = data["*"][0]["a"]["*"] if "*" in data else []
 
-        # Navigate to results in the nested structure
-        results = []
-        if "*" in data:
-            for page in data["*"][0]["a"]["*"]:
+            results = []
+            for page in pages:
                 wikidata = page.get("metadata", {}).get("wikidata")
                 title = page.get("title")
                 if wikidata and title:
@@ -68,12 +215,13 @@ def get_articles_from_category(
                         }
                     )
 
-        return results
+            return results
 
-    except requests.RequestException as e:
+    except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+        # Reading the raw stream raises urllib3's errors instead of requests'
         print(f"Error during request: {e}")
         return []
-    except json.JSONDecodeError as e:
+    except JSON_ERRORS as e:
         print(f"Error parsing JSON response: {e}")
         return []
 
@@ -81,80 +229,246 @@ def get_articles_from_category(
 # Function to get Wikidata IDs for given Wikipedia pages
 def get_wikidata_ids(articles: List[str], lang: str = "en") -> Dict[str, str]:
     """Fetch Wikidata IDs for given Wikipedia article titles."""
-    params = {
-        "action": "query",
-        "format": "json",
-        "prop": "pageprops",
-        "ppprop": "wikibase_item",
-        "titles": "|".join(articles),
-    }
-    response = requests.get(
-        WIKIPEDIA_API_URL_TEMPLATE.format(lang=lang), params=params, timeout=180
-    )
-    response.raise_for_status()
-
-    data = response.json().get("query", {}).get("pages", {})
-    return {
-        page.get("title"): page.get("pageprops", {}).get("wikibase_item")
-        for page in data.values()
-        if "pageprops" in page
-    }
+    url = WIKIPEDIA_API_URL_TEMPLATE.format(lang=lang)
+
+    def query_titles(titles: List[str]) -> Dict[str, str]:
+        params = {
+            "action": "query",
+            "format": "json",
+            "prop": "pageprops",
+            "ppprop": "wikibase_item",
+            "titles": "|".join(titles),
+            "maxlag": MEDIAWIKI_MAXLAG,
+        }
+        ids = {}
+        lagged = 0
+        while True:
+            # POST, so that long titles don't make the URL too long
+            response = SESSION.post(url, data=params, timeout=180)
+            response.raise_for_status()
+
+            data = decode_json(response)
+            if data.get("error", {}).get("code") == "maxlag":
+                # The servers are lagging, wait as long as we are asked to, but
+                # not forever, as often as other failing requests are retried
+                lagged += 1
+                if lagged > RETRY.total:
+                    raise requests.HTTPError(
+                        f"{url} still lagging after {lagged} attempts",
+                        response=response,
+                    )
+                time.sleep(int(response.headers.get("Retry-After", MEDIAWIKI_MAXLAG)))
+                continue
+            lagged = 0
+            pages = data.get("query", {}).get("pages", {})
+            ids.update(
+                {
+                    page.get("title"): page.get("pageprops", {}).get("wikibase_item")
+                    for page in pages.values()
+                    if "pageprops" in page
+                }
+            )
+            if "continue" not in data:
+                return ids
+            params.update(data["continue"])
+
+    ids = {}
+    with ThreadPoolExecutor(max_workers=MEDIAWIKI_MAX_WORKERS) as executor:
+        for batch_ids in executor.map(
+            query_titles, chunked(articles, MEDIAWIKI_MAX_TITLES)
+        ):
+            ids.update(batch_ids)
+    return ids
 
 
 # Function to run a SPARQL query against Wikidata
-def run_sparql_query(query: str) -> List[Dict[str, str]]:
+def run_sparql_query(
+    query: str, verbose: bool = False, refresh: bool = False
+) -> List[Dict[str, str]]:
     """Run a SPARQL query against the Wikidata endpoint."""
+    if refresh:
+        # WDQS caches results by query text, a unique comment makes it run again
+        query += f"\n#{time.time_ns()}"
+    if verbose:
+        print(query)
     headers = {"Accept": "application/sparql-results+json"}
-    response = requests.get(
-        WIKIDATA_SPARQL_ENDPOINT, params={"query": query}, headers=headers, timeout=600
-    )
-    response.raise_for_status()
-
-    return [
-        {key: value.get("value", "") for key, value in binding.items()}
-        for binding in response.json().get("results", {}).get("bindings", [])
-    ]
+    # WDQS only caches GET requests, so use them as long as the query fits the URL
+    if len(query) > SPARQL_MAX_GET_LENGTH:
+        request = {"method": "POST", "data": {"query": query}}
+    else:
+        request = {"method": "GET", "params": {"query": query}}
+    with SESSION.request(
+        url=WIKIDATA_SPARQL_ENDPOINT,
+        headers=headers,
+        timeout=600,
+        stream=True,
+        **request,
+    ) as response:
+        response.raise_for_status()
 
+        if STREAM_JSON:
+            # Parse the bindings while they arrive, without building the whole document
+            response.raw.decode_content = True
+            bindings = ijson.items(response.raw, "results.bindings.item")
+        else:
+            data = decode_json(response)
+            bindings = data.get("results", {}).get("bindings", [])
 
-def url2qid(url: str):
-    return url[31:]
+        return [
+            {key: value.get("value", "") for key, value in binding.items()}
+            for binding in bindings
+        ]
 
 
 def fetch_missing_wikidata_info(
-    lang_code: str, missing_titles: List[str]
+    lang_code: str, missing_titles: List[str], verbose: bool = False
 ) -> List[Dict[str, str]]:
     """Fetch Wikidata information for missing articles."""
 
-    # Helper function for clarity
-    def format_title(title: str, lang_code: str) -> str:
-        escaped_title = title.replace('"', '\\"')  # Escape double quotes
-        return f'"{escaped_title}"@{lang_code}'
+    suffix = f'"@{lang_code}'
 
-    titles_str = " ".join(format_title(title, lang_code) for title in missing_titles)
+    # Query a batch of titles at a time, so that no query runs into the timeout
+    def query_titles(titles: List[str]) -> List[Dict[str, str]]:
+        titles_str = " ".join(
+            '"' + title.translate(SPARQL_STRING_ESCAPES) + suffix for title in titles
+        )
+        query = f"""
+        SELECT DISTINCT ?item ?itemLabel ?itemDescription ?gender ?genderLabel ?dewiki ?enwiki WHERE {{
+          VALUES ?enwiki {{ {titles_str} }}
+          ?item ^schema:about ?article .
+          ?article schema:isPartOf <https://{lang_code}.wikipedia.org/>;
+                  schema:name ?enwiki .
+          OPTIONAL {{
+            ?item wdt:P21 ?gender .
+          }}
+          OPTIONAL {{
+            ?item ^schema:about ?articlede .
+            ?articlede schema:isPartOf <https://de.wikipedia.org/>;
+                       schema:name ?dewiki .
+          }}
+          SERVICE wikibase:label {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],mul,en". }}
+        }}
+        """
+        return run_sparql_query(query, verbose=verbose)
+
+    with ThreadPoolExecutor(max_workers=SPARQL_MAX_WORKERS) as executor:
+        results = executor.map(
+            query_titles, chunked(missing_titles, MISSING_TITLES_BATCH_SIZE)
+        )
+        return list(chain.from_iterable(results))
+
+
+def get_gender_subclasses(
+    gender: str, verbose: bool = False, refresh: bool = False
+) -> List[str]:
+    """Fetch the QIDs of a gender and all of its subclasses."""
+    query = f"SELECT ?gender WHERE {{ ?gender wdt:P279* wd:{gender} . }}"
+    return [
+        result["gender"].rsplit("/", 1)[-1]
+        for result in run_sparql_query(query, verbose=verbose, refresh=refresh)
+    ]
+
+
+def get_labels(
+    qids: Iterable[str], lang: str = "en", verbose: bool = False, refresh: bool = False
+) -> Dict[str, str]:
+    """Fetch the labels of the given Wikidata items."""
+    items_str = " ".join(f"wd:{qid}" for qid in qids)
     query = f"""
-    SELECT DISTINCT ?item ?itemLabel ?itemDescription ?gender ?genderLabel ?dewiki ?enwiki WHERE {{
-      VALUES ?enwiki {{ {titles_str} }}
-      ?item ^schema:about ?article .
-      ?article schema:isPartOf <https://{lang_code}.wikipedia.org/>;
-              schema:name ?enwiki .
-      OPTIONAL {{
-        ?item wdt:P21 ?gender .
-      }}
+    SELECT ?item ?label WHERE {{
+      VALUES ?item {{ {items_str} }}
+      ?item rdfs:label ?label FILTER (lang(?label) = "{lang}") .
+    }}
+    """
+    return {
+        result["item"].rsplit("/", 1)[-1]: result["label"]
+        for result in run_sparql_query(query, verbose=verbose, refresh=refresh)
+    }
+
+
+def get_gender_labels(
+    genders: Iterable[str], verbose: bool = False, refresh: bool = False
+) -> Dict[str, str]:
+    """Get the labels of genders, only querying those not known from earlier runs."""
+    labels = {}
+    if os.path.exists(GENDER_LABELS_FILE):
+        with open(GENDER_LABELS_FILE, encoding="utf-8") as file:
+            labels = json.load(file)
+    new_genders = set(genders).difference(labels)
+    if new_genders:
+        new_labels = get_labels(sorted(new_genders), verbose=verbose, refresh=refresh)
+        # Genders without a label are named by their qid, and not queried again
+        labels.update(
+            {gender: new_labels.get(gender, gender) for gender in new_genders}
+        )
+        with open(GENDER_LABELS_FILE, "w", encoding="utf-8") as file:
+            json.dump(labels, file, ensure_ascii=False, indent=1, sort_keys=True)
+    return labels
+
+
+def build_wikidata_query(genders: List[str], qid_prefix: str = "") -> str:
+    """Build the query for all people with one of the given genders.
+
+    With a qid_prefix, only people whose qid starts with Q + qid_prefix are queried.
+    """
+    genders_str = " ".join(f"wd:{gender}" for gender in genders)
+    projects_str = " ".join(f"?{lang}wiki" for lang in LANG_CODES)
+    sitelinks_str = "".join(f"""
       OPTIONAL {{
-        ?item ^schema:about ?article .
-        ?article schema:isPartOf <https://en.wikipedia.org/>;
-                 schema:name ?enwiki .
-      }}
+        ?enby ^schema:about ?article{lang} .
+        ?article{lang} schema:isPartOf <https://{lang}.wikipedia.org/>;
+                     schema:name ?{lang}wiki .
+      }}""" for lang in LANG_CODES)
+    # Instead of the label service, only the labels used later are queried.
+    # Like the label service, fall back to the qid if there is none.
+    return f"""
+    SELECT DISTINCT ?enby ?enbyLabel ?enbyDescription
+                    (group_concat(distinct STRAFTER(STR(?gender), STR(wd:));separator=" ") as ?genders)
+                    {projects_str} WHERE {{
+      VALUES ?nonbinary {{ {genders_str} }}
+      ?enby wdt:P21 ?nonbinary .
+      FILTER (STRSTARTS(STRAFTER(STR(?enby), STR(wd:)), "Q{qid_prefix}"))
+      ?enby wdt:P31 wd:Q5 .
+      ?enby wdt:P21 ?gender .{sitelinks_str}
+      OPTIONAL {{ ?enby rdfs:label ?labelEn FILTER (lang(?labelEn) = "en") . }}
+      OPTIONAL {{ ?enby rdfs:label ?labelMul FILTER (lang(?labelMul) = "mul") . }}
+      BIND (COALESCE(?labelEn, ?labelMul, STRAFTER(STR(?enby), STR(wd:))) AS ?enbyLabel)
       OPTIONAL {{
-        ?item ^schema:about ?articlede .
-        ?articlede schema:isPartOf <https://de.wikipedia.org/>;
-                   schema:name ?dewiki .
+        ?enby schema:description ?enbyDescription
+        FILTER (lang(?enbyDescription) = "en") .
       }}
-      SERVICE wikibase:label {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],mul,en". }}
-    }}
+    }} group by ?enby ?enbyLabel ?enbyDescription {projects_str}
     """
-    print(query)
-    return run_sparql_query(query)
+
+
+def get_nonbinary_people(
+    verbose: bool = False, refresh: bool = False
+) -> List[Dict[str, str]]:
+    """Fetch all people with a non-binary gender from Wikidata."""
+    nonbinary_genders = get_gender_subclasses(
+        NONBINARY_QID, verbose=verbose, refresh=refresh
+    )
+    print(f"Non-binary genders on Wikidata: {len(nonbinary_genders)}")
+
+    # The parts have no people in common, so they can just be concatenated
+    queries = [
+        build_wikidata_query(nonbinary_genders, prefix)
+        for prefix in SPARQL_QID_PREFIXES
+    ]
+    with ThreadPoolExecutor(max_workers=SPARQL_MAX_WORKERS) as executor:
+        results = executor.map(
+            lambda query: run_sparql_query(query, verbose, refresh), queries
+        )
+        people = list(chain.from_iterable(results))
+
+    # Look up the label of each gender once, instead of once per person
+    genders = {gender for person in people for gender in person["genders"].split()}
+    labels = get_gender_labels(genders, verbose=verbose, refresh=refresh)
+    for person in people:
+        person["wikidata_gender"] = ", ".join(
+            labels.get(gender, gender) for gender in person.pop("genders").split()
+        )
+    return people
 
 
 # Function to write statistics to a file
@@ -166,15 +480,14 @@ def write_statistics(
 ):
     """Write the number of items in each source to a CSV file."""
     today = pd.Timestamp.now().strftime("%Y-%m-%d")
-    # If file does not exist, write header
-    if not os.path.exists(output_file):
-        with open(output_file, "w", encoding="utf-8") as file:
+    with open(output_file, "a", encoding="utf-8") as file:
+        # If the file is new or empty, write header
+        if file.tell() == 0:
             file.write(
                 "#date, collated, wikidata, "
                 + ", ".join(f"{LANG_CODES[lang]}wiki" for lang in LANG_CODES)
                 + "\n"
             )
-    with open(output_file, "a", encoding="utf-8") as file:
         file.write(
             f"{today}, {len(collated)}, {len(wikidata_results)}, "
             + ", ".join(str(len(wikis[project])) for project in wikis)
@@ -188,10 +501,16 @@ def collate(
     wikis: Dict[str, List[Dict[str, str]]],
 ) -> pd.DataFrame:
     """Generate and print a table comparing category and Wikidata articles, and save as HTML."""
-    wd_df = pd.DataFrame.from_dict(wikidata_results)
+    wd_df = pd.DataFrame.from_records(
+        wikidata_results,
+        columns=["enby", "enbyLabel", "enbyDescription", "wikidata_gender"]
+        + [f"{lang}wiki" for lang in LANG_CODES],
+    )
 
     # Replace wikidata-url by qid column
-    wd_df["qid"] = wd_df["enby"].apply(url2qid)
+    wd_df["qid"] = (
+        wd_df["enby"].str.extract(QID_PATTERN, expand=False).fillna(wd_df["enby"])
+    )
     wd_df.drop(columns=["enby"], inplace=True)
 
     wd_df.rename(
@@ -203,249 +522,215 @@ def collate(
         inplace=True,
     )
 
-    merged = wd_df
-    merged["name"] = merged["wikidata"]
-    for projectname, data in wikis.items():
-        df = pd.DataFrame.from_dict(data)
-        merged = merged.merge(
-            df, on="qid", how="outer", suffixes=("", f"_{projectname}")
-        )
+    # Join all category lists onto the Wikidata results in a single pass. The
+    # article titles are renamed, since join can't disambiguate them by suffix
+    category_dfs = [
+        pd.DataFrame.from_records(
+            data, columns=["qid", projectname, f"{projectname}_gender"]
+        ).rename(columns={projectname: f"{projectname}_category"})
+        for projectname, data in wikis.items()
+    ]
 
-        if (
-            projectname in merged.columns
-            and f"{projectname}_{projectname}" in merged.columns
-        ):
-            merged[projectname] = merged[projectname].combine_first(
-                merged[f"{projectname}_{projectname}"]
-            )
-            merged.drop(columns=[f"{projectname}_{projectname}"], inplace=True)
+    # Index everything by integer codes of the qids, so the join doesn't
+    # have to hash and compare the qid strings
+    frames = [wd_df] + category_dfs
+    codes, qids = pd.factorize(pd.concat([df.pop("qid") for df in frames]))
+    codes = codes.astype(np.int32)
+    offset = 0
+    for df in frames:
+        df.index = codes[offset : offset + len(df)]
+        offset += len(df)
+
+    merged = wd_df.join(category_dfs, how="outer")
+
+    for projectname in wikis:
+        category_titles = merged.pop(f"{projectname}_category")
+        if projectname in merged.columns:
+            merged[projectname] = merged[projectname].combine_first(category_titles)
+        else:
+            merged[projectname] = category_titles
 
-        merged["name"] = merged["name"].combine_first(merged[f"{projectname}"])
+    # Name everyone by the first source that has a name for them
+    merged["name"] = merged[["wikidata", *wikis]].bfill(axis=1).iloc[:, 0]
+
+    merged.index = qids.take(merged.index).rename("qid")
+    merged.reset_index(inplace=True)
 
-    merged.fillna(np.nan, inplace=True)
-    merged.replace([np.nan], [None], inplace=True)
     merged.sort_values(by=["name"], inplace=True)
 
     return merged
 
 
+def cached_collate(
+    wikidata_results: List[Dict[str, str]],
+    wikis: Dict[str, List[Dict[str, str]]],
+    use_cache: bool = True,
+) -> pd.DataFrame:
+    """Collate the results, or reuse the table of a run with identical input."""
+    # The pickled table also depends on the code and the pandas version
+    payload = [COLLATE_CACHE_VERSION, pd.__version__, wikidata_results, wikis]
+    key = hashlib.blake2b(
+        json.dumps(payload, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    with shelve.open(COLLATE_CACHE_FILE) as cache:
+        if use_cache and cache.get("key") == key:
+            try:
+                return cache["collated"]
+            except Exception as e:
+                # Unpickling can fail in many ways, just collate again then
+                print(f"Error loading cached table: {e}")
+        collated = collate(wikidata_results, wikis)
+        cache["key"] = key
+        cache["collated"] = collated
+    return collated
+
+
+def render_cells(
+    sites: pd.Series, genders: pd.Series, url: str
+) -> Tuple[pd.Series, np.ndarray]:
+    """Render a column of table cells, return them and a mask of potential errors."""
+    has_site = sites.ne("").to_numpy(np.uint8)
+    state = (has_site << 1) | genders.ne("").to_numpy(np.uint8)
+
+    class_name = pd.Series(CELL_CLASSES[state], index=sites.index)
+    cell = genders.where(state == NONBINARY, CELL_TEXTS[state])
+    link = f'<a href="{url}' + sites + '">' + cell + "</a>"
+    cells = (
+        "<td class='" + class_name + "'>" + link.where(has_site == 1, cell) + "</td>"
+    )
+    return cells, state == WRONG
+
+
 def generate_comparison_table(
     table_data,
     output_html_file: str = "comparison_table.html",
 ):
-    # Write HTML page with styled table
-    html_page = """<!DOCTYPE html>
-<html lang="en">
-<head>
-<meta charset="UTF-8">
-<meta name="viewport" content="width=device-width, initial-scale=1.0">
-<script src="sort.js"></script>
-<title>Non-binary people on Wikipedia – Comparison Table</title>
-<style>
-    body {
-        font-family: Arial, sans-serif;
-        margin: 20px;
-    }
-    table {
-        border-collapse: collapse;
-        width: 100%;
-        margin-top: 20px;
-    }
-    th, td {
-        border: 1px solid #ddd;
-        padding: 8px;
-        text-align: left;
-    }
-    th {
-        background-color: #f2f2f2;
-        position: sticky;
-        top: 0px;
-    }
-    .nonbinary {
-        background-color: #d568de;
-    }
-    .missing {
-        background-color: lightgrey;
-    }
-    .wrong {
-        background-color: #f0e480;
-    }
-    .hidden{
-        display: none;
-    }
-    th {
-        cursor: pointer;
-        background-color: #f9f9f9;
-    }
-    th.sorted-asc::after {
-        content: " ▲";
-    }
-    th.sorted-desc::after {
-        content: " ▼";
-    }
-    tr:hover {
-        filter: contrast(1.1) drop-shadow(0 0 4px white);
-    }
-    a {
-        color: black;
-        text-decoration: none
-    }
-</style>
-</head>
-<body>
-<h1>Non-binary people on Wikipedia – Comparison Table</h1>
-<p>Idea: Compare the gender statement of people who are categorized as non-binary on at least one of these platforms.
-If different platforms have different gender statement, this is likely an error that should be corrected.
-In these cases one should check the sources of the articles to see as what the persons identifies themselves and update the sites.
-</p>
-<p>Purple: Non-binary, Grey: No article, Yellow: Binary gender (likely Wrong?)</p>
-<p>Click on the column headers to sort the table</p>
-<label><input type="checkbox" id="filterCheckbox">Show only potential errors</label>
-<table>
-<thead>
-<tr>
-    <th>Name</th>
-"""
-    for lang in LANG_CODES:
-        html_page += f"<th>{LANG_CODES[lang]} Wikipedia</th>"
-    html_page += """
-    <th>Wikidata</th>
-</tr>
-</thead>
-"""
-
-    error_count = 0
-    error_row_count = 0
-    for _, row in table_data.iterrows():
-        error = False
-
-        # Start building the row
-        name = row.get("name")
-        desc = row.get("description") or ""
-        row_html = ""
-
-        row_html += f"<td><details><summary>{name}</summary>{desc}</details></td>"
+    # The page around the table rows, with $placeholders for the dynamic parts
+    with open(TEMPLATE_FILE, encoding="utf-8") as template_file:
+        header, footer = map(Template, template_file.read().split("<!--ROWS-->"))
 
-        for lang in LANG_CODES:
-            project = f"{lang}wiki"
-            site = row.get(f"{project}")
-            gender = row.get(f"{project}_gender")
-
-            if not site:
-                cell = "no article"
-                class_name = "missing"
-            elif not gender:
-                cell = "binary gender?"
-                class_name = "wrong"
-                error = True
-                error_count += 1
-            else:
-                cell = gender
-                class_name = "nonbinary"
-
-            if site:
-                row_html += f"<td class='{class_name}'>"
-                row_html += f'<a href="https://{lang}.wikipedia.org/wiki/{site}">{cell}</a></td>'
-            else:
-                row_html += f"<td class='{class_name}'>{cell}</td>"
-
-        # Wikidata is different
-        site = row.get("wikidata")
-        qid = row.get("qid")
-        gender = row.get("wikidata_gender")
-
-        if not site or not gender:
-            cell = "binary gender?"
-            class_name = "wrong"
-            error = True
-            error_count += 1
-        else:
-            cell = gender
-            class_name = "nonbinary"
-
-        if qid:
-            row_html += f"<td class='{class_name}'>"
-            row_html += f'<a href="https://www.wikidata.org/wiki/{qid}">{cell}</a></td>'
-        else:
-            row_html += f"<td class='{class_name}'>{cell}</td>"
-
-        # Close the row with a conditional class if error is true
-        row_class = "error" if error else ""
-        if error:
-            error_row_count += 1
-        row_html = f"<tr class='{row_class}'>{row_html}</tr>"
-
-        # Append the row to the full HTML table
-        html_page += row_html
-
-    html_page += f"""</table>
-<h2>Summary</h2>
-<p>Date of generation: {pd.Timestamp.now()}</p>
-<p>People found: {table_data.shape[0]}</p>
-<p>Potentials errors found: {error_count}</p>
-<p>People with Potentials errors found: {error_row_count}</p>
-<p>Source Code: <a href="https://github.com/Nudin/enby_wiki_comparison">GitHub repository</a></p>
-</body>
-</html>"""
+    # Write HTML page with styled table, row by row straight into the file
+    if output_html_file.endswith(".gz"):
+        html_file = gzip.open(output_html_file, "wt", encoding="utf-8", compresslevel=6)
+    else:
+        html_file = open(output_html_file, "w", encoding="utf-8", buffering=1 << 20)
+    with html_file:
+        html_file.write(
+            header.substitute(
+                headings="".join(
+                    f"<th>{LANG_CODES[lang]} Wikipedia</th>" for lang in LANG_CODES
+                )
+            )
+        )
 
-    with open(output_html_file, "w", encoding="utf-8") as html_file:
-        html_file.write(html_page)
+        columns = ["name", "description", "qid", "wikidata", "wikidata_gender"]
+        for lang in LANG_CODES:
+            columns += [f"{lang}wiki", f"{lang}wiki_gender"]
+        data = table_data.reindex(columns=columns).fillna("").astype(str)
+        # Titles, labels and descriptions may contain characters like & < ' "
+        # Article titles and qids are only used in links, so they are url-quoted
+        sites = ["qid"] + [f"{lang}wiki" for lang in LANG_CODES]
+        texts = data.columns.difference(sites)
+        data[sites] = data[sites].apply(lambda column: column.map(quote))
+        data[texts] = data[texts].apply(lambda column: column.map(html.escape))
+
+        # Build the table column by column instead of cell by cell
+        cell_columns = [
+            "<td><details><summary>"
+            + data["name"]
+            + "</summary>"
+            + data["description"]
+            + "</details></td>"
+        ]
+        errors = []
+        for lang in LANG_CODES:
+            cells, wrong = render_cells(
+                data[f"{lang}wiki"],
+                data[f"{lang}wiki_gender"],
+                f"https://{lang}.wikipedia.org/wiki/",
+            )
+            cell_columns.append(cells)
+            errors.append(wrong)
+
+        # Wikidata is different: every person has an item, it can only be wrong
+        cells, wrong = render_cells(
+            data["qid"],
+            data["wikidata_gender"].where(data["wikidata"].ne(""), ""),
+            "https://www.wikidata.org/wiki/",
+        )
+        cell_columns.append(cells)
+        errors.append(wrong)
+
+        # Rows with at least one potential error get a class to filter by
+        errors = np.column_stack(errors)
+        row_errors = errors.any(axis=1)
+        error_count = int(errors.sum())
+        error_row_count = int(row_errors.sum())
+        row_class = pd.Series(np.where(row_errors, "error", ""), index=data.index)
+
+        rows = ("<tr class='" + row_class + "'>").str.cat(cell_columns) + "</tr>"
+        html_file.writelines(rows)
+
+        html_file.write(
+            footer.substitute(
+                date=pd.Timestamp.now(),
+                people=table_data.shape[0],
+                errors=error_count,
+                error_rows=error_row_count,
+            )
+        )
 
 
 # Main program
 if __name__ == "__main__":
-    # Wikipedia categories
-    wikipedia = {}
-    for lang in LANG_CODES:
-        projectname = f"{lang}wiki"
-        # Spanish wp has weird subcategories, so we only get the first level
-        depth = 1 if lang == "es" else 10
-        wikipedia[projectname] = get_articles_from_category(
-            CATEGORIES[lang], lang=lang, depth=depth
+    parser = argparse.ArgumentParser(
+        description="Compare the state of non-binary people in different Wikipedias"
+    )
+    parser.add_argument(
+        "output_html_file",
+        nargs="?",
+        default="comparison_table.html",
+        help="where to write the table, gzip-compressed if the name ends in .gz",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="discard cached responses and query all services again",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="print the SPARQL queries sent"
+    )
+    args = parser.parse_args()
+    if args.no_cache:
+        if requests_cache is not None:
+            SESSION.cache.clear()
+        if os.path.exists(GENDER_LABELS_FILE):
+            os.remove(GENDER_LABELS_FILE)
+
+    # Wikipedia categories and Wikidata, all fetched concurrently
+    categories = {}
+    with ThreadPoolExecutor(max_workers=len(LANG_CODES) + 1) as executor:
+        sparql_future = executor.submit(
+            get_nonbinary_people, verbose=args.verbose, refresh=args.no_cache
         )
-        print(f"Articles in {LANG_CODES[lang]} category: {len(wikipedia[projectname])}")
-
-    # Wikidata query
-    wikidata_query = """
-    SELECT DISTINCT ?enby ?enbyLabel ?enbyDescription
-                    (group_concat(distinct ?genderLabel;separator=", ") as ?wikidata_gender)
-                    ?dewiki ?enwiki ?frwiki ?eswiki WHERE {
-      ?enby wdt:P31 wd:Q5 .
-      ?enby wdt:P21/wdt:P279* wd:Q48270 .
-      ?enby wdt:P21 ?gender .
-      OPTIONAL {
-        ?enby ^schema:about ?article .
-        ?article schema:isPartOf <https://en.wikipedia.org/>;
-                 schema:name ?enwiki .
-      }
-      OPTIONAL {
-        ?enby ^schema:about ?articlede .
-        ?articlede schema:isPartOf <https://de.wikipedia.org/>;
-                   schema:name ?dewiki .
-      }
-      OPTIONAL {
-        ?enby ^schema:about ?articlefr .
-        ?articlefr schema:isPartOf <https://fr.wikipedia.org/>;
-                   schema:name ?frwiki .
-      }
-      OPTIONAL {
-        ?enby ^schema:about ?articlees .
-        ?articlees schema:isPartOf <https://es.wikipedia.org/>;
-                   schema:name ?eswiki .
-      }
-      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],mul,en". }
-        ?gender rdfs:label ?genderLabel FILTER (lang(?genderLabel) = "en") .
-    } group by ?enby ?enbyLabel ?enbyDescription ?dewiki ?enwiki ?frwiki ?eswiki
-    """
-    sparql_results = run_sparql_query(wikidata_query)
-    print(f"SPARQL results: {len(sparql_results)}")
-
-    # Use sys.argv[1] as output file name if provided
-    if len(sys.argv) > 1:
-        output_html_file = sys.argv[1]
-    else:
-        output_html_file = "comparison_table.html"
-    collated = collate(sparql_results, wikipedia)
+        futures = {}
+        for lang in LANG_CODES:
+            # Spanish wp has weird subcategories, so we only get the first level
+            depth = 1 if lang == "es" else 10
+            future = executor.submit(
+                get_articles_from_category, CATEGORIES[lang], lang=lang, depth=depth
+            )
+            futures[future] = lang
+        for future in as_completed(futures):
+            lang = futures[future]
+            categories[lang] = future.result()
+            print(f"Articles in {LANG_CODES[lang]} category: {len(categories[lang])}")
+        sparql_results = sparql_future.result()
+        print(f"SPARQL results: {len(sparql_results)}")
+    # Keep the order of LANG_CODES, the statistics columns depend on it
+    wikipedia = {f"{lang}wiki": categories[lang] for lang in LANG_CODES}
+
+    collated = cached_collate(sparql_results, wikipedia, use_cache=not args.no_cache)
     # Write statistics to a file
     write_statistics(
         wikidata_results=sparql_results, wikis=wikipedia, collated=collated
@@ -453,5 +738,5 @@ if __name__ == "__main__":
     # Generate and print the comparison table
     generate_comparison_table(
         collated,
-        output_html_file=output_html_file,
+        output_html_file=args.output_html_file,
     )